@@ -2,14 +2,22 @@
 #  NeuroAnalyst Backend — Production
 # ==========================================================
 
-import os, re, json, time, uuid, logging
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+import os, re, math, time, uuid, logging, threading, hashlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from datetime import datetime
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 from urllib.parse import urlparse, urljoin
 import tldextract
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from openai import OpenAI
 
 
@@ -22,6 +30,29 @@ FOLLOWUP_PROMPT_URL = "https://docs.google.com/document/d/12nwxCLf4Gk4daR7ecRA04
 
 SESSION_TTL_HOURS = 24
 MAX_SESSIONS = 100
+# Если задан — сессии живут в Redis и общие для всех воркеров gunicorn
+REDIS_URL = os.environ.get("REDIS_URL")
+
+CRAWL_WORKERS = 10
+
+# Промпты из Google Docs кэшируются в процессе; после TTL — условный GET (ETag)
+GDOC_CACHE_TTL = 5 * 60
+
+# Кэш ответов модели по точному ключу
+RESPONSE_CACHE_TTL = 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 500
+
+# Follow-up: последние реплики отправляются как есть, более ранние — сводкой
+HISTORY_WINDOW = 8
+HISTORY_MAX_CHARS = 60_000
+HISTORY_SUMMARY_PROMPT = (
+    "Сожми переписку пользователя с ассистентом о разборе сайта в краткую сводку на русском. "
+    "Сохрани все правки, пожелания и решения пользователя и что уже изменено в анализе. "
+    "Без вступлений, только сводка."
+)
+
+# Сколько ждет повторный /analyze того же сайта, пока первый запрос не закончит
+INFLIGHT_WAIT_TIMEOUT = 180
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,231 +62,681 @@ logging.basicConfig(
 logger = logging.getLogger("neuro-analyst")
 
 
+# -------------------------------
+# 🔌 HTTP-сессия
+# -------------------------------
+# Одна сессия на процесс: keep-alive соединения переиспользуются между
+# запросами к Google Docs и страницами сайта, TLS-рукопожатие — одно на хост
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # Повторяем только сбои соединения и 502/503/504. Таймаут чтения не повторяем:
+    # иначе одна зависшая страница стоит 3 × timeout, а ошибка приходит как ConnectionError
+    max_retries=Retry(
+        total=2,
+        read=False,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+# Accept-Encoding не задаем: requests сам добавляет br, когда установлен brotli
+SESSION.headers.update({
+    "User-Agent": "NeuroAnalystBot/1.0",
+    "Connection": "keep-alive",
+})
+
+
 # -------------------------------
 # 📄 Загрузка Google Docs
 # -------------------------------
+# {url: (etag, last_modified, text, fetched_at)}
+_GDOC_CACHE = {}
+_GDOC_LOCK = threading.Lock()
+
+
 def fetch_gdoc_text(gdoc_url: str) -> str:
-    logger.info(f"📄 Начинаю загрузку Google Doc: {gdoc_url}")
+    with _GDOC_LOCK:
+        cached = _GDOC_CACHE.get(gdoc_url)
+
+    if cached and time.time() - cached[3] < GDOC_CACHE_TTL:
+        logger.info("📄 Google Doc из кэша (%s символов)", format(len(cached[2]), ","))
+        return cached[2]
+
+    logger.info("📄 Начинаю загрузку Google Doc: %s", gdoc_url)
+    headers = {}
+    if cached:
+        etag, last_modified = cached[0], cached[1]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
     try:
-        r = requests.get(gdoc_url, timeout=30)
-        logger.info(f"📄 Статус ответа: {r.status_code}")
+        r = SESSION.get(gdoc_url, timeout=30, headers=headers)
+        logger.info("📄 Статус ответа: %s", r.status_code)
+        if r.status_code == 304 and cached:
+            logger.info("📄 Google Doc не изменился, продлеваю кэш")
+            with _GDOC_LOCK:
+                _GDOC_CACHE[gdoc_url] = (cached[0], cached[1], cached[2], time.time())
+            return cached[2]
         if r.status_code != 200:
-            logger.error(f"❌ Google Doc вернул статус {r.status_code}")
-            logger.error(f"❌ Ответ: {r.text[:500]}")
+            logger.error("❌ Google Doc вернул статус %s", r.status_code)
+            logger.error("❌ Ответ: %s", r.text[:500])
             raise ValueError(f"Ошибка загрузки Google Doc: {r.status_code}")
         text = r.text.strip()
-        logger.info(f"📄 Загружен Google Doc ({len(text):,} символов)")
+        logger.info("📄 Загружен Google Doc (%s символов)", format(len(text), ","))
         if len(text) < 100:
-            logger.warning(f"⚠️ Подозрительно короткий документ: {text[:100]}")
+            logger.warning("⚠️ Подозрительно короткий документ: %s", text[:100])
+        with _GDOC_LOCK:
+            _GDOC_CACHE[gdoc_url] = (
+                r.headers.get("ETag"),
+                r.headers.get("Last-Modified"),
+                text,
+                time.time(),
+            )
         return text
     except requests.RequestException as e:
-        logger.error(f"❌ Ошибка при загрузке Google Doc: {e}")
+        logger.error("❌ Ошибка при загрузке Google Doc: %s", e)
         raise ValueError(f"Ошибка загрузки документа: {e}")
     except Exception as e:
-        logger.error(f"❌ Неожиданная ошибка: {e}", exc_info=True)
+        logger.error("❌ Неожиданная ошибка: %s", e, exc_info=True)
         raise ValueError(f"Ошибка загрузки документа: {e}")
 
 
 # -------------------------------
 # 🌐 Нормализация ссылок
 # -------------------------------
+_BAD_RE = re.compile(r"^(?:mailto|tel|javascript|whatsapp|viber|tg|sms|skype):|^#")
+_SCHEME_RE = re.compile(r"^https?://", re.IGNORECASE)
+
+
 def normalize_link(base, href: str):
     if not href or not isinstance(href, str):
         return None
 
     href = href.strip()
 
-    bad_prefixes = (
-        "mailto:", "tel:", "javascript:", "whatsapp:", "viber:",
-        "tg:", "#", "sms:", "skype:",
-    )
-    if href.startswith(bad_prefixes):
+    if _BAD_RE.match(href):
         return None
 
-    if href.startswith("http://") or href.startswith("https://"):
-        return href.split("#")[0]
+    clean = href.partition("#")[0]
 
-    if href.startswith("//"):
-        return "https:" + href.split("#")[0]
+    if _SCHEME_RE.match(clean):
+        return clean
 
-    return urljoin(base, href.split("#")[0])
+    if clean.startswith("//"):
+        return "https:" + clean
+
+    return urljoin(base, clean)
 
 
 # -------------------------------
 # 🔎 Парсинг сайта
 # -------------------------------
-def same_domain(a, b):
+@lru_cache(maxsize=4096)
+def _reg_dom(url):
     try:
-        return tldextract.extract(a).registered_domain == tldextract.extract(b).registered_domain
+        return tldextract.extract(url).registered_domain
     except:
-        return False
+        return None
+
+
+def _dumps(obj):
+    # orjson в разы быстрее stdlib json на больших юникодных payload, не экранирует кириллицу
+    return orjson.dumps(obj).decode()
 
 
 def safe_json(obj):
     try:
-        json.dumps(obj)
+        _dumps(obj)
         return obj
     except:
         return str(obj)
 
 
-def crawl_site(start_url, max_pages=25, depth=1):
-    logger.info(f"🔎 Начинаю парсинг: {start_url}")
-    logger.info(f"🔎 Параметры: max_pages={max_pages}, depth={depth}")
-    
-    visited, queue = set(), [(start_url, 0)]
-    pages = []
+SKIP_TAGS = {"script", "style", "noscript"}
+MAX_PAGE_TEXT = 20000
+MAX_PAGE_BYTES = 2_000_000
+HTML_TYPES = ("text/html", "application/xhtml")
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
 
-    while queue and len(pages) < max_pages:
-        url, d = queue.pop(0)
-        if url in visited or d > depth:
-            continue
 
-        visited.add(url)
-        logger.info(f"🌐 [{len(pages)+1}/{max_pages}]: {url}")
+def response_charset(content_type):
+    m = _CHARSET_RE.search(content_type or "")
+    return m.group(1) if m else None
 
-        try:
-            logger.info(f"🌐 Делаю запрос к {url}...")
-            r = requests.get(url, timeout=30, headers={"User-Agent": "NeuroAnalystBot/1.0"})
-            logger.info(f"🌐 Статус: {r.status_code}")
-            
-            if r.status_code != 200:
-                logger.warning(f"⚠️ Пропускаю {url}: статус {r.status_code}")
+
+def extract_page(content, encoding=None):
+    """Один проход по дереву lxml: заголовок, текст, meta и href ссылок."""
+    try:
+        parser = lxml.html.HTMLParser(remove_blank_text=True, encoding=encoding)
+    except LookupError:
+        parser = lxml.html.HTMLParser(remove_blank_text=True)
+    root = lxml.html.document_fromstring(content, parser=parser)
+
+    title, meta, hrefs = "", {}, []
+    text_parts, text_len = [], 0
+    skip_depth = 0
+
+    for event, el in etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+        if event == "start":
+            tag = el.tag
+            if tag in SKIP_TAGS:
+                skip_depth += 1
+                continue
+            if skip_depth:
                 continue
 
-            logger.info(f"🌐 Парсинг HTML...")
-            soup = BeautifulSoup(r.text, "html.parser")
-            for s in soup(["script", "style", "noscript"]):
-                s.extract()
-
-            title = soup.title.string.strip() if soup.title else ""
-            text = soup.get_text("\n", strip=True)[:20000]
-            logger.info(f"🌐 Извлечено {len(text)} символов текста")
-
-            meta = {
-                m.get("name", m.get("property", "")): m.get("content", "")
-                for m in soup.find_all("meta")
-                if m.get("name") or m.get("property")
-            }
-
-            links = []
-            for a in soup.find_all("a", href=True):
-                link = normalize_link(url, a["href"])
-                if link and same_domain(start_url, link):
-                    links.append(link)
-
-            logger.info(f"🌐 Найдено {len(links)} ссылок")
-            
-            pages.append({
-                "url": url,
-                "title": title,
-                "meta": safe_json(meta),
-                "text": text,
-                "links": links
-            })
-
-            for l in links:
-                if l not in visited:
-                    queue.append((l, d + 1))
-
-        except requests.Timeout:
-            logger.error(f"⚠️ Таймаут при загрузке {url}")
-        except requests.RequestException as e:
-            logger.error(f"⚠️ Ошибка сети для {url}: {e}")
-        except Exception as e:
-            logger.error(f"⚠️ Ошибка парсинга {url}: {e}", exc_info=True)
+            if tag == "title":
+                if not title:
+                    title = (el.text or "").strip()
+            elif tag == "meta":
+                name = el.get("name") or el.get("property")
+                if name:
+                    meta[name] = el.get("content", "")
+            elif tag == "a":
+                href = el.get("href")
+                if href:
+                    hrefs.append(href)
+
+            chunk = el.text
+        elif event == "end":
+            if el.tag in SKIP_TAGS:
+                skip_depth -= 1
+            if skip_depth:
+                continue
+            chunk = el.tail
+        else:
+            # Комментарии и PI: сам узел не текст, но хвост после него — текст
+            if skip_depth:
+                continue
+            chunk = el.tail
+
+        # Текст дальше лимита не копим, но ссылки и meta собираем до конца
+        if chunk and text_len < MAX_PAGE_TEXT:
+            chunk = chunk.strip()
+            if chunk:
+                text_parts.append(chunk)
+                text_len += len(chunk) + 1
+
+    return {
+        "title": title,
+        "text": "\n".join(text_parts)[:MAX_PAGE_TEXT],
+        "meta": meta,
+        "hrefs": hrefs,
+    }
+
 
-    logger.info(f"✅ Парсинг завершен. Собрано {len(pages)} страниц")
-    return {"start_url": start_url, "pages": pages, "count": len(pages)}
+def fetch_page(url):
+    """Качает страницу потоково: не-HTML отсекаем по заголовкам, тело режем по MAX_PAGE_BYTES."""
+    with SESSION.get(url, timeout=30, stream=True) as r:
+        content_type = r.headers.get("Content-Type", "")
+        if r.status_code != 200 or (content_type and not content_type.lower().startswith(HTML_TYPES)):
+            return r.status_code, content_type, None
+
+        chunks, size = [], 0
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= MAX_PAGE_BYTES:
+                logger.warning("⚠️ %s: страница больше %s байт, обрезаю", url, format(MAX_PAGE_BYTES, ","))
+                break
+
+        return r.status_code, content_type, b"".join(chunks)[:MAX_PAGE_BYTES]
+
+
+def crawl_site(start_url, max_pages=25, depth=1):
+    logger.info("🔎 Начинаю парсинг: %s", start_url)
+    logger.info("🔎 Параметры: max_pages=%s, depth=%s", max_pages, depth)
+
+    # Каждый URL попадает в очередь ровно один раз — дубли отсекаем при постановке
+    queued = {start_url}
+    pages = []
+    # Сбои загрузки (сеть, таймауты, 5xx, парсинг) — неполный обход не кэшируем
+    errors = 0
+    # Домен стартовой страницы считаем один раз на весь обход
+    start_reg = _reg_dom(start_url)
+    current_level, d = deque([start_url]), 0
+
+    # Обход по уровням: все URL текущей глубины качаются параллельно,
+    # а разбор и постановка ссылок в очередь идут последовательно в этом потоке
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as ex:
+        while current_level and d <= depth and len(pages) < max_pages:
+            next_level = deque()
+
+            while current_level and len(pages) < max_pages:
+                # Берем не больше страниц, чем осталось до лимита
+                batch = []
+                while current_level and len(batch) < max_pages - len(pages):
+                    batch.append(current_level.popleft())
+
+                logger.info("🌐 Уровень %s: загружаю %s страниц параллельно...", d, len(batch))
+                futures = [(url, ex.submit(fetch_page, url)) for url in batch]
+
+                for url, fut in futures:
+                    if len(pages) >= max_pages:
+                        break
+
+                    logger.info("🌐 [%s/%s]: %s", len(pages)+1, max_pages, url)
+
+                    try:
+                        status, content_type, body = fut.result()
+                        logger.info("🌐 Статус: %s", status)
+
+                        if status != 200:
+                            logger.warning("⚠️ Пропускаю %s: статус %s", url, status)
+                            if status >= 500 or status == 429:
+                                errors += 1
+                            continue
+
+                        if not body:
+                            logger.warning("⚠️ Пропускаю %s: не HTML или пустой ответ (%s)", url, content_type)
+                            continue
+
+                        logger.info("🌐 Парсинг HTML...")
+                        page = extract_page(body, response_charset(content_type))
+                        title, text, meta = page["title"], page["text"], page["meta"]
+                        logger.info("🌐 Извлечено %s символов текста", len(text))
+
+                        # dict как упорядоченное множество: дубли (меню, футер) схлопываются,
+                        # а порядок ссылок на странице сохраняется
+                        links_set = {}
+                        for href in page["hrefs"]:
+                            link = normalize_link(url, href)
+                            if link and link not in links_set and start_reg is not None and _reg_dom(link) == start_reg:
+                                links_set[link] = None
+                        links = list(links_set)
+
+                        logger.info("🌐 Найдено %s ссылок", len(links))
+
+                        pages.append({
+                            "url": url,
+                            "title": title,
+                            "meta": safe_json(meta),
+                            "text": text,
+                            "links": links
+                        })
+
+                        if d < depth:
+                            for l in links:
+                                if l not in queued:
+                                    queued.add(l)
+                                    next_level.append(l)
+
+                    except requests.Timeout:
+                        logger.error("⚠️ Таймаут при загрузке %s", url)
+                        errors += 1
+                    except requests.RequestException as e:
+                        logger.error("⚠️ Ошибка сети для %s: %s", url, e)
+                        errors += 1
+                    except Exception as e:
+                        logger.error("⚠️ Ошибка парсинга %s: %s", url, e, exc_info=True)
+                        errors += 1
+
+                # Лимит достигнут — незавершенные загрузки уже не нужны
+                for _, fut in futures:
+                    fut.cancel()
+
+            current_level, d = next_level, d + 1
+
+    logger.info("✅ Парсинг завершен. Собрано %s страниц", len(pages))
+    return {"start_url": start_url, "pages": pages, "count": len(pages), "errors": errors}
+
+
+def slim_site_data(site_data):
+    """Компактная версия обхода для модели: без ссылок, без повторяющегося меню/футера."""
+    pages = site_data["pages"]
+    page_lines = [
+        [" ".join(line.split()) for line in p["text"].split("\n") if line.strip()]
+        for p in pages
+    ]
+
+    # Строка, встречающаяся больше чем на половине страниц, — шаблон сайта
+    seen_on = Counter(line for lines in page_lines for line in set(lines))
+    limit = math.ceil(len(pages) / 2)
+
+    # Шаблонные строки оставляем один раз, на первой странице где они встретились
+    emitted = set()
+    slim_pages = []
+    for p, lines in zip(pages, page_lines):
+        kept = []
+        for line in lines:
+            if seen_on[line] > limit:
+                if line in emitted:
+                    continue
+                emitted.add(line)
+            kept.append(line)
+        slim_pages.append({
+            "url": p["url"],
+            "title": p["title"],
+            "meta": p["meta"],
+            "text": "\n".join(kept),
+        })
+
+    before = sum(len(p["text"]) for p in pages)
+    after = sum(len(p["text"]) for p in slim_pages)
+    logger.info("✂️ Текст страниц для модели: %s → %s символов", format(before, ","), format(after, ","))
+
+    return {"start_url": site_data["start_url"], "pages": slim_pages, "count": site_data["count"]}
 
 
 # -------------------------------
 # 🤖 Модели
 # -------------------------------
-def call_main_model(client, prompt_text, site_data):
+def call_main_model(client, prompt_text, site_data, stream=False):
     logger.info("🤖 Запрос к gpt-5-mini...")
-    logger.info(f"🤖 Размер промпта: {len(prompt_text)} символов")
-    logger.info(f"🤖 Количество страниц в site_data: {site_data.get('count', 0)}")
+    logger.info("🤖 Размер промпта: %s символов", len(prompt_text))
+    logger.info("🤖 Количество страниц в site_data: %s", site_data.get('count', 0))
     
+    # Сериализуем один раз: это же тело идет и в запрос, и в лог размера
+    user_body = _dumps({"site": site_data})
     messages = [
         {"role": "system", "content": prompt_text},
-        {"role": "user", "content": json.dumps({"site": site_data}, ensure_ascii=False)},
+        {"role": "user", "content": user_body},
     ]
     
-    total_chars = len(prompt_text) + len(json.dumps(site_data))
-    logger.info(f"🤖 Общий размер запроса: {total_chars:,} символов")
+    total_chars = len(prompt_text) + len(user_body)
+    logger.info("🤖 Общий размер запроса: %s символов", format(total_chars, ","))
     
     try:
         logger.info("🤖 Отправляю запрос к OpenAI...")
         # БЕЗ ТАЙМАУТОВ - пусть ждет сколько надо
+        if stream:
+            resp = client.chat.completions.create(
+                model="gpt-5-mini",
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            logger.info("✅ Стрим открыт для gpt-5-mini")
+            return resp
         resp = client.chat.completions.create(model="gpt-5-mini", messages=messages)
-        logger.info(f"✅ Ответ получен от gpt-5-mini")
-        logger.info(f"✅ Токены: {resp.usage.total_tokens:,} (prompt: {resp.usage.prompt_tokens:,}, completion: {resp.usage.completion_tokens:,})")
+        logger.info("✅ Ответ получен от gpt-5-mini")
+        logger.info("✅ Токены: %s (prompt: %s, completion: %s)", format(resp.usage.total_tokens, ","), format(resp.usage.prompt_tokens, ","), format(resp.usage.completion_tokens, ","))
         return resp
     except Exception as e:
-        logger.error(f"❌ Ошибка при вызове gpt-5-mini: {e}", exc_info=True)
+        logger.error("❌ Ошибка при вызове gpt-5-mini: %s", e, exc_info=True)
         raise
 
 
-def call_followup_model(client, followup_prompt_text, json_payload):
+def call_followup_model(client, followup_prompt_text, json_payload, stream=False):
     logger.info("💬 Follow-up запрос...")
-    logger.info(f"💬 Размер промпта: {len(followup_prompt_text)} символов")
-    logger.info(f"💬 User instruction: {json_payload.get('user_instruction', 'НЕТ')[:100]}")
+    logger.info("💬 Размер промпта: %s символов", len(followup_prompt_text))
+    logger.info("💬 User instruction: %s", (json_payload.get('user_instruction') or 'НЕТ')[:100])
     
+    # Статичная часть (промпт, первый анализ, прошлые реплики) идет первой и не меняется
+    # между запросами сессии — так срабатывает кэш префикса промпта на стороне OpenAI.
+    # Новая инструкция — всегда отдельным последним сообщением.
     messages = [
         {"role": "system", "content": followup_prompt_text},
-        {"role": "user", "content": json.dumps(json_payload, ensure_ascii=False)},
+        {"role": "assistant", "content": json_payload.get("first_output") or ""},
+    ]
+    if json_payload.get("earlier_summary"):
+        messages.append({
+            "role": "system",
+            "content": f"Краткое содержание более ранней переписки:\n{json_payload['earlier_summary']}",
+        })
+    messages += [
+        *json_payload.get("conversation_history", []),
+        {"role": "user", "content": json_payload.get("user_instruction") or ""},
     ]
     
-    total_chars = len(followup_prompt_text) + len(json.dumps(json_payload))
-    logger.info(f"💬 Общий размер запроса: {total_chars:,} символов")
+    total_chars = sum(len(m["content"] or "") for m in messages)
+    logger.info("💬 Общий размер запроса: %s символов", format(total_chars, ","))
     
     try:
         logger.info("💬 Отправляю follow-up запрос к OpenAI...")
         # БЕЗ ТАЙМАУТОВ - пусть ждет сколько надо
+        if stream:
+            resp = client.chat.completions.create(
+                model="gpt-5-mini",
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            logger.info("✅ Follow-up стрим открыт для gpt-5-mini")
+            return resp
         resp = client.chat.completions.create(model="gpt-5-mini", messages=messages)
-        logger.info(f"✅ Follow-up ответ получен от gpt-5-mini")
-        logger.info(f"✅ Токены: {resp.usage.total_tokens:,} (prompt: {resp.usage.prompt_tokens:,}, completion: {resp.usage.completion_tokens:,})")
+        logger.info("✅ Follow-up ответ получен от gpt-5-mini")
+        logger.info("✅ Токены: %s (prompt: %s, completion: %s)", format(resp.usage.total_tokens, ","), format(resp.usage.prompt_tokens, ","), format(resp.usage.completion_tokens, ","))
         return resp
     except Exception as e:
-        logger.error(f"❌ Ошибка при вызове follow-up gpt-5-mini: {e}", exc_info=True)
+        logger.error("❌ Ошибка при вызове follow-up gpt-5-mini: %s", e, exc_info=True)
         raise
 
 
+def summarize_history(client, previous_summary, messages):
+    logger.info("🗜️ Сжимаю %s старых сообщений истории...", len(messages))
+
+    parts = []
+    if previous_summary:
+        parts.append(f"Краткое содержание до этого:\n{previous_summary}")
+    parts.append("Новые сообщения:\n" + "\n\n".join(f"{m['role']}: {m['content']}" for m in messages))
+
+    resp = client.chat.completions.create(
+        model="gpt-5-mini",
+        messages=[
+            {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+            {"role": "user", "content": "\n\n".join(parts)},
+        ],
+    )
+    summary = resp.choices[0].message.content
+    logger.info("🗜️ История сжата до %s символов", len(summary))
+    return summary
+
+
+def trim_history(messages, max_chars):
+    # Жесткий предел по символам: выбрасываем самые старые, последнюю пару оставляем всегда
+    total = sum(len(m.get("content") or "") for m in messages)
+    start = 0
+    while total > max_chars and len(messages) - start > 2:
+        total -= len(messages[start].get("content") or "")
+        start += 1
+    if start:
+        logger.warning("⚠️ История обрезана по лимиту символов: -%s сообщений", start)
+    return messages[start:]
+
+
+def sse_event(data):
+    return f"data: {_dumps(data)}\n\n"
+
+
+def stream_model_output(resp, on_complete):
+    """Пересылает токены модели как SSE; в конце отдает результат on_complete(полный текст)."""
+    parts = []
+    try:
+        for chunk in resp:
+            if chunk.usage:
+                logger.info("✅ Токены: %s (prompt: %s, completion: %s)", format(chunk.usage.total_tokens, ","), format(chunk.usage.prompt_tokens, ","), format(chunk.usage.completion_tokens, ","))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        yield sse_event(on_complete("".join(parts)))
+    except Exception as e:
+        logger.error("❌ Ошибка во время стрима gpt-5-mini: %s", e, exc_info=True)
+        yield sse_event({"error": str(e)})
+
+
+# -------------------------------
+# 🧠 Кэш ответов
+# -------------------------------
+def normalize_cache_key(text):
+    return " ".join((text or "").lower().split())
+
+
+class ResponseCache:
+    """Кэш ответов модели по точному (нормализованному) ключу с TTL.
+
+    Записи изолированы по scope (промпт, состояние сессии), поэтому ответ,
+    построенный на другом контексте, никогда не вернется.
+    """
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # {(scope, key): (response, expires_at)} в порядке добавления
+        self._entries = {}
+
+    def lookup(self, scope, key_text):
+        key = normalize_cache_key(key_text)
+        with self._lock:
+            hit = self._entries.get((scope, key))
+            if hit and hit[1] > time.time():
+                return hit[0]
+        return None
+
+    def store(self, scope, key_text, response):
+        key = normalize_cache_key(key_text)
+        now = time.time()
+
+        with self._lock:
+            self._entries.pop((scope, key), None)
+            self._entries[(scope, key)] = (response, now + self.ttl)
+
+            for k in [k for k, (_, exp) in self._entries.items() if exp <= now]:
+                del self._entries[k]
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+
 # -------------------------------
 # 🗄️ Управление сессиями
 # -------------------------------
-STORE = {}
+class MemorySessionStore:
+    """Сессии в памяти процесса. Порядок вставки = порядок последнего сохранения,
+    поэтому просроченные и лишние сессии снимаются с начала за O(1) на штуку."""
+
+    def __init__(self, ttl_seconds, max_sessions):
+        self.ttl = ttl_seconds
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()  # {sid: (expires_at, sess)}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            item = self._data.get(sid)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._data[sid]
+                return None
+            return item[1]
+
+    def exists(self, sid):
+        return self.get(sid) is not None
+
+    def save(self, sid, sess):
+        now = time.time()
+        with self._lock:
+            self._data.pop(sid, None)
+            self._data[sid] = (now + self.ttl, sess)
+
+            evicted = 0
+            while self._data:
+                oldest_sid, (expires_at, _) = next(iter(self._data.items()))
+                if expires_at > now and len(self._data) <= self.max_sessions:
+                    break
+                del self._data[oldest_sid]
+                evicted += 1
+
+        if evicted:
+            logger.info("🧹 Очищено %s сессий (TTL/лимит)", evicted)
+
+    def update(self, sid, fields):
+        sess = self.get(sid)
+        if sess is not None:
+            sess.update(fields)
+            self.save(sid, sess)
+
+    def count(self):
+        return len(self._data)
+
+
+class RedisSessionStore:
+    """Сессии в Redis: общие для всех воркеров, истекают сами через EXPIRE.
+
+    Поля сессии лежат в хеше sess:<sid>, а тяжелый обход сайта — отдельным ключом
+    sess:<sid>:site: он пишется один раз в /analyze, и follow-up его не читает.
+    """
+
+    def __init__(self, url, ttl_seconds):
+        import redis
+
+        self.ttl = ttl_seconds
+        self._r = redis.Redis(connection_pool=redis.ConnectionPool.from_url(url, max_connections=20))
+
+    @staticmethod
+    def _key(sid):
+        return f"sess:{sid}"
+
+    def get(self, sid):
+        """Сессия без поля site."""
+        raw = self._r.hgetall(self._key(sid))
+        if not raw:
+            return None
+        return {k.decode(): orjson.loads(v) for k, v in raw.items()}
+
+    def exists(self, sid):
+        return bool(self._r.exists(self._key(sid)))
+
+    def save(self, sid, sess):
+        key = self._key(sid)
+        fields = {k: orjson.dumps(v) for k, v in sess.items() if k != "site"}
+        with self._r.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            pipe.setex(f"{key}:site", self.ttl, orjson.dumps(sess.get("site")))
+            pipe.execute()
+
+    def update(self, sid, fields):
+        key = self._key(sid)
+        with self._r.pipeline() as pipe:
+            pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+            pipe.expire(key, self.ttl)
+            pipe.expire(f"{key}:site", self.ttl)
+            pipe.execute()
+
+    def count(self):
+        # Точный подсчет потребовал бы SCAN по всему keyspace на каждый /ping
+        return None
 
-def cleanup_old_sessions():
-    now = datetime.now()
-    to_delete = [
-        sid for sid, sess in STORE.items()
-        if sess.get("created_at") and (now - sess["created_at"]) > timedelta(hours=SESSION_TTL_HOURS)
-    ]
-    
-    for sid in to_delete:
-        del STORE[sid]
-    
-    if to_delete:
-        logger.info(f"🧹 Очищено {len(to_delete)} старых сессий")
 
+def make_session_store():
+    ttl = SESSION_TTL_HOURS * 3600
+    if REDIS_URL:
+        logger.info("🗄️ Сессии хранятся в Redis")
+        return RedisSessionStore(REDIS_URL, ttl)
+    logger.info("🗄️ Сессии хранятся в памяти процесса (лимит %s)", MAX_SESSIONS)
+    return MemorySessionStore(ttl, MAX_SESSIONS)
 
-def limit_sessions():
-    if len(STORE) > MAX_SESSIONS:
-        sorted_sessions = sorted(STORE.items(), key=lambda x: x[1].get("created_at", datetime.min))
-        to_delete = len(STORE) - MAX_SESSIONS
-        
-        for sid, _ in sorted_sessions[:to_delete]:
-            del STORE[sid]
-        
-        logger.info(f"🧹 Очищено {to_delete} сессий (лимит)")
+
+SESSIONS = make_session_store()
 
 
 # -------------------------------
 # 🌍 Flask API
 # -------------------------------
+class OrjsonProvider(JSONProvider):
+    """request.get_json() и jsonify() через orjson вместо stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Получаем OpenAI client из env
@@ -264,90 +745,197 @@ if not api_key:
     logger.error("❌ OPENAI_API_KEY не установлен в переменных окружения!")
     raise ValueError("OPENAI_API_KEY не найден в переменных окружения")
 
-logger.info(f"🔑 OpenAI API key загружен (последние 4 символа: ...{api_key[-4:]})")
+logger.info("🔑 OpenAI API key загружен (последние 4 символа: ...%s)", api_key[-4:])
 OPENAI_CLIENT = OpenAI(api_key=api_key)
 logger.info("✅ OpenAI клиент инициализирован")
 
+RESPONSE_CACHE = ResponseCache()
+# Записи /analyze держат весь обход сайта (до ~1 МБ), поэтому их лимит — как у сессий
+ANALYZE_CACHE = ResponseCache(max_entries=MAX_SESSIONS)
+
 
 @app.route("/ping", methods=["GET"])
 def ping():
     return jsonify({
         "status": "alive",
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-        "sessions": len(STORE)
+        "sessions": SESSIONS.count()
     }), 200
 
 
+# Дедупликация одновременных /analyze одного сайта: {(scope, key): Future}
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def acquire_inflight(key):
+    """Возвращает (future, owner). Владелец выполняет анализ, остальные ждут future."""
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        if fut is not None:
+            return fut, False
+        fut = Future()
+        _INFLIGHT[key] = fut
+        return fut, True
+
+
+def release_inflight(key, fut, result=None, error=None):
+    with _INFLIGHT_LOCK:
+        if _INFLIGHT.get(key) is fut:
+            del _INFLIGHT[key]
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+def wants_stream(data):
+    return bool(data.get("stream")) or "text/event-stream" in request.headers.get("Accept", "")
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def replay_output(text, on_complete):
+    # Ответ из кэша отдаем в том же формате, что и живой стрим
+    yield sse_event({"delta": text})
+    yield sse_event(on_complete(text))
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     logger.info("=" * 60)
     logger.info("🆕 /analyze")
     
-    # Детальное логирование запроса
-    logger.info(f"Request data: {request.json}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    
-    cleanup_old_sessions()
-    limit_sessions()
+    # Детальное логирование запроса — только в DEBUG, тела и заголовки бывают большими
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request data: %s", request.get_json(silent=True))
+        logger.debug("Headers: %s", dict(request.headers))
     
     data = request.json or {}
     site_url = data.get("site_url")
     existing_sid = data.get("session_id")
+    stream = wants_stream(data)
     
-    logger.info(f"📝 site_url: {site_url}")
-    logger.info(f"📝 existing_sid: {existing_sid}")
+    logger.info("📝 site_url: %s", site_url)
+    logger.info("📝 existing_sid: %s", existing_sid)
 
     if not site_url:
         logger.warning("⚠️ Отсутствует site_url")
         return jsonify({"error": "Нужно указать site_url"}), 400
 
     # Переиспользуем session_id если передан и существует
-    if existing_sid and existing_sid in STORE:
+    if existing_sid and SESSIONS.exists(existing_sid):
         sid = existing_sid
-        logger.info(f"♻️ Переиспользую session_id: {sid}")
+        logger.info("♻️ Переиспользую session_id: %s", sid)
     else:
         sid = str(uuid.uuid4())
-        logger.info(f"🆕 Новый session_id: {sid}")
+        logger.info("🆕 Новый session_id: %s", sid)
 
     try:
         logger.info("📄 Шаг 1: Загружаю промпт из Google Doc...")
         main_prompt = fetch_gdoc_text(MAIN_PROMPT_URL)
-        logger.info(f"📄 Промпт загружен: {len(main_prompt)} символов")
-        
-        logger.info("🌐 Шаг 2: Начинаю парсинг сайта...")
-        site_data = crawl_site(site_url)
-        logger.info(f"🌐 Парсинг завершен: {site_data['count']} страниц")
+        logger.info("📄 Промпт загружен: %s символов", len(main_prompt))
         
-        logger.info("🤖 Шаг 3: Отправляю данные в GPT...")
-        resp = call_main_model(OPENAI_CLIENT, main_prompt, site_data)
-        
-        logger.info("🤖 Шаг 4: Извлекаю ответ...")
-        model_output = resp.choices[0].message.content
-        logger.info(f"🤖 Размер ответа: {len(model_output)} символов")
+        # Ключ кэша привязан к версии промпта: правка документа сбрасывает кэш
+        cache_scope = f"analyze:{hashlib.sha1(main_prompt.encode()).hexdigest()[:16]}"
+        cache_key = site_url.strip().rstrip("/")
+        cached = ANALYZE_CACHE.lookup(cache_scope, cache_key)
+
+        owner = False
+        if not cached:
+            # Тот же сайт уже анализируется другим запросом — ждем его результат
+            inflight_key = (cache_scope, normalize_cache_key(cache_key))
+            inflight, owner = acquire_inflight(inflight_key)
+            if not owner:
+                logger.info("⏳ Анализ %s уже выполняется, жду результат...", site_url)
+                try:
+                    cached = inflight.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+                except FutureTimeoutError:
+                    logger.error("❌ Не дождался параллельного анализа %s за %s с", site_url, INFLIGHT_WAIT_TIMEOUT)
+                    return jsonify({"error": "Анализ этого сайта уже выполняется и не завершился вовремя, попробуйте позже"}), 504
+
+        if cached:
+            logger.info("⚡ Анализ %s найден в кэше", site_url)
+            site_data, resp = cached["site"], None
+        else:
+            try:
+                logger.info("🌐 Шаг 2: Начинаю парсинг сайта...")
+                site_data = crawl_site(site_url)
+                logger.info("🌐 Парсинг завершен: %s страниц", site_data['count'])
+
+                logger.info("🤖 Шаг 3: Отправляю данные в GPT...")
+                # Модели — облегченная версия, в сессии остается полный обход
+                resp = call_main_model(OPENAI_CLIENT, main_prompt, slim_site_data(site_data), stream=stream)
+            except Exception as e:
+                release_inflight(inflight_key, inflight, error=e)
+                raise
 
     except Exception as e:
-        logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА в /analyze: {e}", exc_info=True)
+        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА в /analyze: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 500
 
-    # ПОЛНАЯ перезапись сессии
-    logger.info("💾 Сохраняю сессию...")
-    STORE[sid] = {
-        "site": site_data,
-        "first_output": model_output,
-        "last_followup": None,
-        "history": [],
-        "created_at": datetime.now()
-    }
-    logger.info(f"💾 Сессия {sid} сохранена")
-
-    logger.info(f"✅ Анализ завершён успешно")
-    logger.info("=" * 60)
+    def finish(model_output):
+        if resp is not None:
+            logger.info("🤖 Размер ответа: %s символов", len(model_output))
+            result = {"site": site_data, "result": model_output}
+            # Пустой или частично упавший обход не кэшируем: следующий запрос переобойдет сайт
+            if site_data["count"] > 0 and not site_data.get("errors"):
+                ANALYZE_CACHE.store(cache_scope, cache_key, result)
+            else:
+                logger.warning(
+                    "⚠️ Обход неполный (страниц: %s, ошибок: %s) — результат не кэширую",
+                    site_data["count"], site_data.get("errors", 0),
+                )
+            release_inflight(inflight_key, inflight, result=result)
+
+        # ПОЛНАЯ перезапись сессии
+        logger.info("💾 Сохраняю сессию...")
+        SESSIONS.save(sid, {
+            "site": site_data,
+            "first_output": model_output,
+            "last_followup": None,
+            "history": [],
+            "created_at": datetime.now().isoformat()
+        })
+        logger.info("💾 Сессия %s сохранена", sid)
+
+        logger.info("✅ Анализ завершён успешно")
+        logger.info("=" * 60)
+
+        return {
+            "session_id": sid,
+            "result": model_output,
+            "pages": site_data["count"]
+        }
+
+    if stream:
+        if resp is None:
+            return sse_response(replay_output(cached["result"], finish))
+
+        response = sse_response(stream_model_output(resp, finish))
+        # Ответ закрыт раньше finish (даже если тело ни разу не читали) —
+        # ожидающие не должны висеть до таймаута
+        response.call_on_close(
+            lambda: release_inflight(inflight_key, inflight, error=RuntimeError("Анализ прерван"))
+        )
+        return response
+
+    if resp is None:
+        return jsonify(finish(cached["result"]))
 
-    return jsonify({
-        "session_id": sid,
-        "result": model_output,
-        "pages": site_data["count"]
-    })
+    try:
+        logger.info("🤖 Шаг 4: Извлекаю ответ...")
+        return jsonify(finish(resp.choices[0].message.content))
+    finally:
+        release_inflight(inflight_key, inflight, error=RuntimeError("Анализ прерван"))
 
 
 @app.route("/followup", methods=["POST"])
@@ -358,57 +946,106 @@ def followup():
     data = request.json or {}
     sid = data.get("session_id")
     user_instruction = data.get("followup_prompt")
+    stream = wants_stream(data)
     
-    logger.info(f"📝 session_id: {sid}")
-    logger.info(f"📝 user_instruction: {user_instruction[:100] if user_instruction else 'НЕТ'}")
+    logger.info("📝 session_id: %s", sid)
+
+    # Инструкция уходит в историю как реплика пользователя — пустая сломала бы все следующие запросы
+    if not isinstance(user_instruction, str) or not user_instruction.strip():
+        logger.warning("⚠️ Отсутствует followup_prompt")
+        return jsonify({"error": "Нужно указать followup_prompt"}), 400
 
-    if not sid or sid not in STORE:
-        logger.warning(f"⚠️ session_id {sid} не найден в STORE")
-        logger.info(f"⚠️ Доступные сессии: {list(STORE.keys())}")
+    logger.info("📝 user_instruction: %s", user_instruction[:100])
+
+    sess = SESSIONS.get(sid) if sid else None
+    if sess is None:
+        logger.warning("⚠️ session_id %s не найден", sid)
         return jsonify({"error": "session_id не найден"}), 404
 
-    sess = STORE[sid]
-    logger.info(f"📂 Сессия найдена. История: {len(sess.get('history', []))} сообщений")
+    logger.info("📂 Сессия найдена. История: %s сообщений", len(sess.get('history', [])))
 
     try:
         logger.info("📄 Загружаю follow-up промпт...")
         followup_prompt_text = fetch_gdoc_text(FOLLOWUP_PROMPT_URL)
-        logger.info(f"📄 Follow-up промпт загружен: {len(followup_prompt_text)} символов")
+        logger.info("📄 Follow-up промпт загружен: %s символов", len(followup_prompt_text))
     except Exception as e:
-        logger.error(f"❌ Ошибка загрузки follow-up промпта: {e}", exc_info=True)
+        logger.error("❌ Ошибка загрузки follow-up промпта: %s", e, exc_info=True)
         return jsonify({"error": f"Ошибка загрузки промпта: {e}"}), 500
 
+    # Модели уходит сводка старых реплик + последние сообщения. Сводка пересчитывается
+    # пачкой, когда хвост вырастает до 2 окон: между пересчетами префикс запроса
+    # не меняется и продолжает попадать в кэш промпта OpenAI.
+    history = sess.get("history", [])
+    summarized = sess.get("summarized", 0)
+    if len(history) - summarized > 2 * HISTORY_WINDOW:
+        fold_upto = len(history) - HISTORY_WINDOW
+        try:
+            sess["summary"] = summarize_history(OPENAI_CLIENT, sess.get("summary"), history[summarized:fold_upto])
+            sess["summarized"] = summarized = fold_upto
+            # Сохраняем сразу: если дальше упадет вызов модели, сводку не придется считать заново
+            SESSIONS.update(sid, {"summary": sess["summary"], "summarized": summarized})
+        except Exception as e:
+            logger.warning("⚠️ Не удалось сжать историю, отправляю без сжатия: %s", e)
+
     payload = {
         "first_output": sess.get("first_output"),
-        "last_followup": sess.get("last_followup"),
-        "conversation_history": sess.get("history", []),
+        "earlier_summary": sess.get("summary"),
+        "conversation_history": trim_history(history[summarized:], HISTORY_MAX_CHARS),
         "user_instruction": user_instruction
     }
     
-    logger.info(f"📦 Размер payload: {len(json.dumps(payload))} символов")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📦 Размер payload: %s символов", len(_dumps(payload)))
 
     try:
-        logger.info("🤖 Отправляю follow-up запрос в GPT...")
-        resp = call_followup_model(OPENAI_CLIENT, followup_prompt_text, payload)
-        
-        logger.info("🤖 Извлекаю ответ...")
-        model_text = resp.choices[0].message.content
-        logger.info(f"🤖 Размер ответа: {len(model_text)} символов")
+        # Кэш валиден только для того же состояния диалога
+        state = sess.get("last_followup") or sess.get("first_output") or ""
+        cache_scope = f"followup:{sid}:{len(sess.get('history', []))}:{hashlib.sha1(state.encode()).hexdigest()[:16]}"
+        cached = RESPONSE_CACHE.lookup(cache_scope, user_instruction)
+
+        if cached:
+            logger.info("⚡ Follow-up ответ найден в кэше")
+            resp = None
+        else:
+            logger.info("🤖 Отправляю follow-up запрос в GPT...")
+            resp = call_followup_model(OPENAI_CLIENT, followup_prompt_text, payload, stream=stream)
+
+    except Exception as e:
+        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА в /followup: %s", e, exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+    def finish(model_text):
+        if resp is not None:
+            logger.info("🤖 Размер ответа: %s символов", len(model_text))
+            RESPONSE_CACHE.store(cache_scope, user_instruction, model_text)
 
         logger.info("💾 Обновляю сессию...")
         sess["last_followup"] = model_text
         sess["history"].append({"role": "user", "content": user_instruction})
         sess["history"].append({"role": "assistant", "content": model_text})
-        logger.info(f"💾 История обновлена: {len(sess['history'])} сообщений")
+        SESSIONS.update(sid, {
+            "last_followup": model_text,
+            "history": sess["history"],
+            "summary": sess.get("summary"),
+            "summarized": sess.get("summarized", 0),
+        })
+        logger.info("💾 История обновлена: %s сообщений", len(sess['history']))
 
-    except Exception as e:
-        logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА в /followup: {e}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        logger.info("✅ Follow-up завершён успешно")
+        logger.info("=" * 60)
 
-    logger.info(f"✅ Follow-up завершён успешно")
-    logger.info("=" * 60)
+        return {"result": model_text}
+
+    if stream:
+        if resp is None:
+            return sse_response(replay_output(cached, finish))
+        return sse_response(stream_model_output(resp, finish))
+
+    if resp is None:
+        return jsonify(finish(cached))
 
-    return jsonify({"result": model_text})
+    logger.info("🤖 Извлекаю ответ...")
+    return jsonify(finish(resp.choices[0].message.content))
 
 
 @app.route("/clear-chat", methods=["POST"])
@@ -416,16 +1053,15 @@ def clear_chat():
     data = request.json or {}
     sid = data.get("session_id")
 
-    if not sid or sid not in STORE:
+    sess = SESSIONS.get(sid) if sid else None
+    if sess is None:
         return jsonify({"error": "session_id не найден"}), 404
 
-    sess = STORE[sid]
     messages_count = len(sess.get("history", []))
     
-    sess["history"] = []
-    sess["last_followup"] = None
+    SESSIONS.update(sid, {"history": [], "last_followup": None, "summary": None, "summarized": 0})
     
-    logger.info(f"🧹 Очищен чат ({messages_count} сообщений)")
+    logger.info("🧹 Очищен чат (%s сообщений)", messages_count)
 
     return jsonify({
         "status": "success",
@@ -0,0 +1,36 @@
+# Gunicorn configuration file
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+# Без Redis сессии, кэши и дедупликация /analyze живут в памяти процесса —
+# второй воркер не увидел бы чужих сессий, поэтому тогда воркер один
+REDIS_CONFIGURED = bool(os.environ.get("REDIS_URL"))
+workers = 2 if REDIS_CONFIGURED else 1
+# Потоковые воркеры: запрос, ждущий OpenAI/Google Docs/сайт, не блокирует остальные.
+# Кэши, сессии и дедупликация /analyze в app.py рассчитаны на потоки (под локами)
+worker_class = "gthread"
+threads = 16
+timeout = 300  # 5 минут на парсинг сайта + обработку GPT
+# Перезапуск воркера стер бы in-memory сессии, поэтому без Redis он отключен
+max_requests = 1000 if REDIS_CONFIGURED else 0
+max_requests_jitter = 50 if REDIS_CONFIGURED else 0
+
+# Logging
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
+
+# Process naming
+proc_name = 'neuroanalyst-backend'
+
+# Server mechanics
+daemon = False
+pidfile = None
+user = None
+group = None
+tmp_upload_dir = None
+
+# SSL (если понадобится)
+keyfile = None
+certfile = None